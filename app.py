@@ -1,40 +1,137 @@
 import streamlit as st
 import fitz  # PyMuPDF
-import pandas as pd
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Border, Font, Side
 import re
 import io
 from datetime import datetime
 
+try:
+    # Optional Aho-Corasick automaton: one linear pass for all literal labels.
+    # pyahocorasick is left out of requirements.txt on purpose; without it the
+    # label and ABN scans use precompiled stdlib patterns, which are nearly as fast
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 # -----------------------------------------
 # Constants for Party Detection
 # -----------------------------------------
-ADDRESS_WORDS = set("""
+ADDRESS_WORDS = frozenset("""
 PO BOX GPO LOCKED BAG CONTACT PHONE FAX EMAIL NSW VIC QLD SA WA TAS ACT NT
 MELBOURNE SYDNEY BRISBANE ADELAIDE PERTH HOBART CANBERRA RHODES TOOWOOMBA
 """.split())
 NEXT_SEP_RE = re.compile(r"(LOCKED|GPO|PO\s+BOX|ABN)\b", re.IGNORECASE)
 CONTACT_RE  = re.compile(r"CONTACT\b", re.IGNORECASE)
-SUFFIXES = {"PTY","LTD","LIMITED","TRUST","COMPANY","CO","INC","LLC","LLP","AUSTRALIA","AUST"}
+ABN_RE      = re.compile(r"\bABN\s*:\s*((?:\d\s*){10}\d)\b", re.IGNORECASE)
+SUFFIXES = frozenset({"PTY","LTD","LIMITED","TRUST","COMPANY","CO","INC","LLC","LLP","AUSTRALIA","AUST"})
+# Byte table mapping everything but ASCII letters to a space; non-ASCII text
+# is first encoded with "?" replacements so it splits just like [^A-Za-z]+
+_ALPHA_TABLE = bytes(c if 65 <= c <= 90 or 97 <= c <= 122 else 32 for c in range(256))
 ADDRESS_HINTS = re.compile(
     r"\b(PO BOX|GPO|LOCKED BAG|STREET|ROAD|RD|AVE|AVENUE|DRIVE|DR|LANE|LN|CR|"
     r"QLD|NSW|VIC|SA|WA|TAS|ACT|NT|\d{3,4})\b",
     re.IGNORECASE
 )
 
+# Every casing of "ABN", since ABN_RE is case-insensitive ("ABN" first: the usual one)
+_ABN_CASINGS = tuple(sorted({a + b + n for a in "Aa" for b in "Bb" for n in "Nn"}))
+
+_ABN_AUTOMATON = None
+if ahocorasick is not None:
+    _ABN_AUTOMATON = ahocorasick.Automaton()
+    for _abn in _ABN_CASINGS:
+        _ABN_AUTOMATON.add_word(_abn, _abn)
+    _ABN_AUTOMATON.make_automaton()
+
+def _iter_abn_matches(text: str):
+    """
+    Same matches as ABN_RE.finditer, but ABN_RE only runs anchored at the
+    literal "ABN" hits the automaton finds instead of scanning the whole text.
+    """
+    if _ABN_AUTOMATON is None:
+        # Substring checks are far cheaper than a full regex scan on docs with no ABN
+        if any(abn in text for abn in _ABN_CASINGS):
+            yield from ABN_RE.finditer(text)
+        return
+    last_end = 0
+    for end, _ in _ABN_AUTOMATON.iter(text):
+        if end - 2 < last_end:
+            continue
+        m = ABN_RE.match(text, end - 2)
+        if m:
+            last_end = m.end()
+            yield m
+
+# -----------------------------------------
+# Constants for Field Extraction
+# -----------------------------------------
+DATE_RE = re.compile(r"\b(\d{1,2}\s+[A-Za-z]{3,9}\s+\d{4})\b")
+FIELD_LABELS = (
+    "Commodity","Quality","Quantity","Price","Delivery","Payment",
+    "Insurance","Freight","Storage","Weights","Special Conditions","Brokerage","Rules",
+)
+# One pattern per label: each starts with a literal, so re can skip ahead to
+# it, which an alternation over every label can't
+FIELD_LABEL_RES = tuple((label, re.compile(re.escape(label) + r":\s*")) for label in FIELD_LABELS)
+# A field's value runs until the next label-like line or EOF
+NEXT_LABEL_RE = re.compile(r"\n[A-Z][A-Za-z ]{1,40}:\s")
+
+_LABEL_KEYS = tuple(f"{label}:" for label in FIELD_LABELS)
+
+_LABEL_AUTOMATON = None
+if ahocorasick is not None:
+    _LABEL_AUTOMATON = ahocorasick.Automaton()
+    for _key, _label in zip(_LABEL_KEYS, FIELD_LABELS):
+        _LABEL_AUTOMATON.add_word(_key, _label)
+    _LABEL_AUTOMATON.make_automaton()
+_WS_RUN_RE = re.compile(r"\s*")
+
+def _iter_field_labels(text: str):
+    """
+    Yield (label, start, value_start) for every field label occurrence.
+    value_start skips the whitespace after the colon. Each label's occurrences
+    come in text order; only the automaton also keeps text order across labels.
+    """
+    if _LABEL_AUTOMATON is None:
+        for label, pattern in FIELD_LABEL_RES:
+            m = pattern.search(text)
+            while m:
+                yield label, m.start(), m.end()
+                m = pattern.search(text, m.end())
+        return
+    for end, label in _LABEL_AUTOMATON.iter(text):
+        yield label, end - len(label), _WS_RUN_RE.match(text, end + 1).end()
+
 # -----------------------------------------
 # PDF Text Extraction & Normalization
 # -----------------------------------------
-def extract_text_from_pdf(file) -> str:
-    data = file.read()
-    doc = fitz.open(stream=data, filetype="pdf")
-    text = "\n".join(page.get_text("text") for page in doc)
-    # Normalize for robust regex matching
-    text = text.replace("\xa0", " ")
-    text = text.replace("**", "\n")        # <<< fix: keep block boundaries from bold markers
-    text = re.sub(r"[：﹕]", ":", text)     # normalize colon variants
-    text = re.sub(r"[–—−]", "-", text)     # normalize dash variants
-    text = re.sub(r"[ \t]+", " ", text)    # collapse spaces
-    text = re.sub(r"\s*\n\s*", "\n", text) # tidy newlines
+SPACE_RE   = re.compile(r"[ \t]+")
+# Any run of whitespace but \n (nbsp, tabs, thin spaces...) becomes one space,
+# so NEWLINE_RE only ever sees spaces and newlines
+INLINE_SPACE_RE = re.compile(r"[^\S\n]+")
+# After INLINE_SPACE_RE at most one space precedes a newline, so this stays linear
+# (\s*\n\s* rescans long newline-free whitespace runs from every position)
+NEWLINE_RE = re.compile(r" ?\n[ \n]*")
+
+def _iter_normalized_pages(doc):
+    # These fixes are page-local, so apply them while the page text is fresh.
+    # str.replace skips ahead to each variant; str.translate would visit every
+    # char one by one on any page that isn't pure ASCII
+    for page in doc:
+        page_text = page.get_text("text").replace("**", "\n")  # <<< fix: keep block boundaries from bold markers
+        page_text = page_text.replace("：", ":").replace("﹕", ":")  # normalize colon variants
+        page_text = page_text.replace("–", "-").replace("—", "-").replace("−", "-")  # normalize dash variants
+        yield INLINE_SPACE_RE.sub(" ", page_text)  # collapse spaces
+
+@st.cache_data(show_spinner=False)
+def extract_text_from_pdf(data: bytes) -> str:
+    # Close the document as soon as the text is out to free MuPDF's C-side state
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        text = "\n".join(_iter_normalized_pages(doc))
+    # Newline runs can span the page joins, so this tidy runs on the whole text
+    text = NEWLINE_RE.sub("\n", text)      # tidy newlines
     return text
 
 
@@ -46,33 +143,39 @@ def extract_parties(text: str):
     Detect Buyer/Seller by pairing each ABN with the nearest preceding uppercase
     company line. Prefer the full uppercase line; fall back to suffix/token logic.
     """
-    abn_matches = list(re.finditer(r"\bABN\s*:\s*((?:\d\s*){11})\b", text, re.IGNORECASE))
-    parties = []
+    # Buyer is the first named ABN, seller the last *new* one; a repeat of an
+    # ABN that already has a name can't change either, so skip its window work
+    buyer = seller = ("", "")
+    seen = set()
 
-    for m in abn_matches:
+    for m in _iter_abn_matches(text):
         idx = m.start()
-        abn = re.sub(r"\D", "", m.group(1))
+        abn = "".join(m.group(1).split())  # group is digits + whitespace only
 
         # Skip obvious header ABN (broker letterhead) near the top
-        if idx < 300:
+        if idx < 300 or abn in seen:
             continue
 
         # Look back a bit from the ABN
         win = text[max(0, idx - 280): idx]
 
         # Start after last CONTACT in the window to avoid person names
-        contact_hits = list(CONTACT_RE.finditer(win))
-        if contact_hits:
-            win = win[contact_hits[-1].end():]
+        last_contact = None
+        for last_contact in CONTACT_RE.finditer(win):
+            pass
+        if last_contact:
+            win = win[last_contact.end():]
 
         # Keep text before the next address marker (LOCKED/GPO/PO BOX/ABN)
         segment = NEXT_SEP_RE.split(win, maxsplit=1)[0].strip()
 
         # ---------- PRIMARY: line-based capture ----------
-        # Split the segment by lines and pick the last uppercase, non-address line
+        # Walk the segment's lines back from the ABN; stop at the first company line
         company_line = ""
-        lines = [ln.strip() for ln in segment.split("\n") if ln.strip()]
-        for ln in reversed(lines):
+        for ln in reversed(segment.split("\n")):
+            ln = ln.strip()
+            if not ln:
+                continue
             up = ln.upper()
             if "CONTACT" in up:
                 continue
@@ -89,7 +192,8 @@ def extract_parties(text: str):
             name = company_line
         else:
             # ---------- FALLBACK: suffix/token capture ----------
-            tokens = [t for t in re.split(r"[^A-Za-z]+", segment) if t]
+            # One pass over letter runs; translate + split instead of a regex split
+            tokens = segment.encode("ascii", "replace").translate(_ALPHA_TABLE).decode("ascii").split()
             uc_tokens = [t for t in tokens if t.isupper() and t not in ADDRESS_WORDS]
             name = ""
             if uc_tokens:
@@ -108,48 +212,37 @@ def extract_parties(text: str):
                     name = " ".join(uc_tokens[-min(4, len(uc_tokens)):])
 
         if name and len(name.split()) >= 2:
-            parties.append((name, abn, idx))
-
-    # De-duplicate by ABN and sort by position
-    seen, ordered = set(), []
-    for n, a, i in parties:
-        if a not in seen:
-            ordered.append((n, a, i))
-            seen.add(a)
-    ordered.sort(key=lambda x: x[2])
-
-    buyer_name = ordered[0][0] if len(ordered) > 0 else ""
-    buyer_abn  = ordered[0][1] if len(ordered) > 0 else ""
-    seller_name = ordered[-1][0] if len(ordered) > 1 else ""
-    seller_abn  = ordered[-1][1] if len(ordered) > 1 else ""
-    return buyer_name, buyer_abn, seller_name, seller_abn
+            # ABN matches arrive in document order, so no sort is needed
+            if not seen:
+                buyer = (name, abn)
+            else:
+                seller = (name, abn)
+            seen.add(abn)
+
+    return buyer[0], buyer[1], seller[0], seller[1]
     
 # -----------------------------------------
 # Field Extraction
 # -----------------------------------------
+@st.cache_data(show_spinner=False)
 def extract_fields(text: str) -> dict:
     # Parties
     buyer_name, buyer_abn, seller_name, seller_abn = extract_parties(text)
 
     # Date (generic patterns, normalize to dd/mm/YYYY)
     date_str = ""
-    mdate = re.search(r"\b(\d{1,2}\s+[A-Za-z]{3,9}\s+\d{4})\b", text)
+    mdate = DATE_RE.search(text)
     if mdate:
         raw = mdate.group(1)
         for fmt in ("%d %b %Y", "%d %B %Y"):
             try:
                 date_str = datetime.strptime(raw, fmt).strftime("%d/%m/%Y")
                 break
-            except Exception:
+            except ValueError:
                 pass
         if not date_str:
             date_str = raw
 
-    # Colon-based labels → capture until next label-like line or EOF
-    labels = [
-        "Commodity","Quality","Quantity","Price","Delivery","Payment",
-        "Insurance","Freight","Storage","Weights","Special Conditions","Brokerage","Rules"
-    ]
     fields = {
         "Buyer": buyer_name,
         "Buyer ABN": buyer_abn,
@@ -157,17 +250,27 @@ def extract_fields(text: str) -> dict:
         "Seller ABN": seller_abn,
         "Date": date_str,
     }
-    for label in labels:
-        pat = re.compile(rf"{label}:\s*(.+?)(?=\n[A-Z][A-Za-z ]{{1,40}}:\s|$)", re.DOTALL)
-        m = pat.search(text)
-        fields[label] = m.group(1).strip() if m else ""
+    # The first non-empty occurrence of each label wins
+    fields.update(dict.fromkeys(FIELD_LABELS, ""))
+    for label, _, value_start in _iter_field_labels(text):
+        if fields[label]:
+            continue
+        nxt = NEXT_LABEL_RE.search(text, value_start + 1)
+        fields[label] = text[value_start:nxt.start() if nxt else len(text)].strip()
 
     # Light tidy: first line for Price, compact whitespace
     if fields["Price"]:
-        fields["Price"] = fields["Price"].splitlines()[0].strip()
-    for k, v in list(fields.items()):
-        if isinstance(v, str):
-            fields[k] = re.sub(r"[ \t]+", " ", v.strip())
+        # "\n" is the only line break left after normalization; no list of all lines
+        fields["Price"] = fields["Price"].partition("\n")[0].strip()
+    # Only existing keys are reassigned, so iterating the live dict is safe
+    for k, v in fields.items():
+        if not v or not isinstance(v, str):
+            continue  # empty fields are common and need no tidy
+        v = v.strip()
+        # SPACE_RE only changes tabs and multi-space runs; most values have neither
+        if "  " in v or "\t" in v:
+            v = SPACE_RE.sub(" ", v)
+        fields[k] = v
 
     return fields
 
@@ -181,8 +284,28 @@ _MONTHS = {
     'JUL': '07','AUG': '08','SEP': '09','SEPT': '09','OCT': '10','NOV': '11','DEC': '12',
 }
 
+# Day-first or month-first in one scan; the named groups say which matched
+_TEXT_DATE_RE = re.compile(
+    r"\b(?:(?P<dmy_d>\d{1,2})\s+(?P<dmy_m>[A-Za-z]{3,9})"
+    r"|(?P<mdy_m>[A-Za-z]{3,9})\s+(?P<mdy_d>\d{1,2}))\s+(?P<y>\d{4})\b",
+    re.IGNORECASE,
+)
+
+AMOUNT_RE  = re.compile(r"(A\$|\$)\s*([0-9][0-9,]*\.?\d*)", re.IGNORECASE)
+_QTY_RE    = re.compile(r"([0-9][0-9,]*\.?\d*)")
+_MINMAX_RE = re.compile(r"\bMIN/MAX\b", re.IGNORECASE)
+_DAY_SUFFIX_RE = re.compile(r"(\d{1,2})(st|nd|rd|th)", re.IGNORECASE)
+# Delivery: day-level dates ('DECEMBER 1ST 2025' / '1 Dec 2025'), else a month range
+_DELIVERY_DATE_RE = re.compile(
+    r"([A-Za-z]{3,9}\s+\d{1,2}(?:st|nd|rd|th)?\s+\d{4}|\d{1,2}\s+[A-Za-z]{3,9}\s+\d{4})",
+    re.IGNORECASE,
+)
+_MONTH_RANGE_RE = re.compile(
+    r"([A-Za-z]{3,9})\s+(\d{4})\s+TO\s+([A-Za-z]{3,9})\s+(\d{4})", re.IGNORECASE
+)
+
 def _strip_day_suffix(s: str) -> str:
-    return re.sub(r"(\d{1,2})(st|nd|rd|th)", r"\1", s, flags=re.IGNORECASE)
+    return _DAY_SUFFIX_RE.sub(r"\1", s)
 
 def _parse_text_date(s: str) -> str:
     """
@@ -190,37 +313,42 @@ def _parse_text_date(s: str) -> str:
     Returns '' if no parse.
     """
     s = _strip_day_suffix(s).strip()
-    m1 = re.search(r"\b(\d{1,2})\s+([A-Za-z]{3,9})\s+(\d{4})\b", s, re.IGNORECASE)
-    m2 = re.search(r"\b([A-Za-z]{3,9})\s+(\d{1,2})\s+(\d{4})\b", s, re.IGNORECASE)
-    dd = mm = yyyy = None
-    if m1:
-        dd, mon, yyyy = m1.group(1), m1.group(2), m1.group(3)
-    elif m2:
-        mon, dd, yyyy = m2.group(1), m2.group(2), m2.group(3)
-    if not (dd and yyyy and mon):
+    m = _TEXT_DATE_RE.search(s)
+    if not m:
         return ""
+    if m.group("dmy_d"):
+        dd, mon = m.group("dmy_d"), m.group("dmy_m")
+    else:
+        dd, mon = m.group("mdy_d"), m.group("mdy_m")
+    yyyy = m.group("y")
     mm = _MONTHS.get(mon.upper(), "")
     if not mm:
         return ""
     dd = f"{int(dd):02d}"
     return f"{dd}/{mm}/{yyyy}"
 
-def _format_price(val: str) -> str:
-    # pick first currency amount like $340.00 or A$ 340
-    m = re.search(r"(A\$|\$)\s*([0-9][0-9,]*\.?\d*)", val, re.IGNORECASE)
+def _parse_amount(val: str) -> str:
+    # first currency amount like $340.00 or A$ 340 as 'X.XX'; '' if none
+    m = AMOUNT_RE.search(val)
     if not m:
-        return val
+        return ""
     amount = m.group(2).replace(",", "")
     try:
         amount = f"{float(amount):.2f}"
     except:
         pass
+    return amount
+
+def _format_price(val: str) -> str:
+    amount = _parse_amount(val)
+    if not amount:
+        return val
     # per your spec: lowercase /mt
     return f"${amount}/mt"
 
 def _format_quantity(val: str) -> str:
     # find first number; keep (MIN/MAX) if present
-    m = re.search(r"([0-9][0-9,]*\.?\d*)", val)
+    m = _QTY_RE.search(val)
     out = val
     if m:
         num = m.group(1).replace(",", "")
@@ -229,18 +357,17 @@ def _format_quantity(val: str) -> str:
         except:
             pass
         out = f"{num}mt"
-        if re.search(r"\bMIN/MAX\b", val, re.IGNORECASE):
+        if _MINMAX_RE.search(val):
             out += " (MIN/MAX)"
     return out
 
 def _format_delivery(val: str) -> str:
     # extract two dates from a phrase like 'DECEMBER 1ST 2025 TO JANUARY 29TH 2026'
-    # or '1 Dec 2025 to 29 Jan 2026'; if month-only, output MM/YYYY - MM/YYYY
-    seg = val.replace("—", "-").replace(" to ", " TO ").replace("–", "-")
+    # or '1 Dec 2025 to 29 Jan 2026'; if month-only, output MM/YYYY - MM/YYYY.
+    # Dashes are already normalized at extraction and TO matches case-insensitively.
     # First try to find two day-level dates
     date_tokens = []
-    for m in re.finditer(r"([A-Za-z]{3,9}\s+\d{1,2}(?:st|nd|rd|th)?\s+\d{4}|\d{1,2}\s+[A-Za-z]{3,9}\s+\d{4})",
-                         seg, re.IGNORECASE):
+    for m in _DELIVERY_DATE_RE.finditer(val):
         parsed = _parse_text_date(m.group(0))
         if parsed:
             date_tokens.append(parsed)
@@ -249,7 +376,7 @@ def _format_delivery(val: str) -> str:
     if len(date_tokens) == 2:
         return f"{date_tokens[0]} - {date_tokens[1]}"
     # Else, try Month Year -> Month Year
-    m = re.search(r"([A-Za-z]{3,9})\s+(\d{4})\s+TO\s+([A-Za-z]{3,9})\s+(\d{4})", seg, re.IGNORECASE)
+    m = _MONTH_RANGE_RE.search(val)
     if m:
         m1, y1, m2, y2 = m.group(1), m.group(2), m.group(3), m.group(4)
         mm1 = _MONTHS.get(m1.upper(), "")
@@ -261,18 +388,14 @@ def _format_delivery(val: str) -> str:
 
 def _format_brokerage(val: str) -> str:
     # find A$ or $ amount; output A$X.XX/MT (EXCL GST)
-    m = re.search(r"(A\$|\$)\s*([0-9][0-9,]*\.?\d*)", val, re.IGNORECASE)
-    if not m:
+    amount = _parse_amount(val)
+    if not amount:
         return val
-    amount = m.group(2).replace(",", "")
-    try:
-        amount = f"{float(amount):.2f}"
-    except:
-        pass
     return f"A${amount}/MT (EXCL GST)"
 
 def format_output(fields: dict) -> dict:
-    out = dict(fields)
+    # Formats in place: the cached extract_fields hands back a fresh copy per call
+    out = fields
     # Price
     if out.get("Price"):
         out["Price"] = _format_price(out["Price"])
@@ -290,13 +413,39 @@ def format_output(fields: dict) -> dict:
 # -----------------------------------------
 # Excel Output
 # -----------------------------------------
-def generate_excel(fields: dict) -> io.BytesIO:
-    df = pd.DataFrame(list(fields.items()), columns=["Field", "Value"])
+# Header row styled as pandas' to_excel wrote it: bold, thin border, centred
+_HEADER_FONT = Font(bold=True)
+_THIN_SIDE = Side(style="thin")
+_HEADER_BORDER = Border(left=_THIN_SIDE, right=_THIN_SIDE, top=_THIN_SIDE, bottom=_THIN_SIDE)
+_HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="top")
+
+def _header_row(ws) -> list:
+    row = []
+    for title in ("Field", "Value"):
+        cell = WriteOnlyCell(ws, value=title)
+        cell.font, cell.border, cell.alignment = _HEADER_FONT, _HEADER_BORDER, _HEADER_ALIGNMENT
+        row.append(cell)
+    return row
+
+@st.cache_data(show_spinner=False)
+def generate_excel(fields: dict) -> bytes:
+    return generate_excel_batch([fields])
+
+def generate_excel_batch(fields_iter) -> bytes:
+    """
+    One workbook for many PDFs: a "Field"/"Value" sheet per fields dict
+    (Sheet1, Sheet2, ...), streamed through a single write-only workbook.
+    """
+    wb = Workbook(write_only=True)
+    for n, fields in enumerate(fields_iter, 1):
+        ws = wb.create_sheet(f"Sheet{n}")
+        ws.append(_header_row(ws))
+        for key, value in fields.items():
+            ws.append([key, value])
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine="openpyxl") as writer:
-        df.to_excel(writer, index=False)
-    output.seek(0)
-    return output
+    wb.save(output)
+    # Plain bytes are cheap for the cache to store and st.download_button takes them as-is
+    return output.getvalue()
 
 # -----------------------------------------
 # Streamlit UI
@@ -307,13 +456,14 @@ st.write("Upload a broker advice PDF to extract key fields and download a vertic
 uploaded_file = st.file_uploader("Upload PDF", type=["pdf"])
 
 if uploaded_file:
-    text = extract_text_from_pdf(uploaded_file)
+    # Cached on the raw bytes, so widget-triggered reruns skip the PDF parse
+    text = extract_text_from_pdf(uploaded_file.getvalue())
     fields = extract_fields(text)
     fields = format_output(fields)   # <-- Apply your display formatting here
 
     st.subheader("Extracted Fields")
-    for key, value in fields.items():
-        st.write(f"**{key}:** {value}")
+    # One markdown element (a paragraph per field) instead of a component per field
+    st.markdown("\n\n".join(f"**{key}:** {value}" for key, value in fields.items()))
 
     excel_data = generate_excel(fields)
     st.download_button(